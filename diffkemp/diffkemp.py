@@ -411,6 +411,10 @@ def compare(args):
     result = Result(Result.Kind.NONE, args.snapshot_dir_old,
                     args.snapshot_dir_old, start_time=default_timer())
 
+    # Pattern for filtering results by regex
+    regex_filter = re.compile(args.regex_filter) \
+        if args.regex_filter is not None else None
+
     for group_name, group in sorted(config.snapshot_first.fun_groups.items()):
         group_printed = False
 
@@ -461,11 +465,10 @@ def compare(args):
             result_graph = fun_result.graph
 
             if fun_result is not None:
-                if args.regex_filter is not None:
+                if regex_filter is not None:
                     # Filter results by regex
-                    pattern = re.compile(args.regex_filter)
                     for called_res in fun_result.inner.values():
-                        if pattern.search(called_res.diff):
+                        if regex_filter.search(called_res.diff):
                             break
                     else:
                         fun_result.kind = Result.Kind.EQUAL
@@ -573,7 +576,7 @@ def print_syntax_diff(snapshot_dir_old, snapshot_dir_new, fun, fun_result,
     new_dir_abs_path = os.path.join(os.path.abspath(snapshot_dir_new), "")
 
     if fun_result.kind == Result.Kind.NOT_EQUAL or (
-            full_diff and any([x.diff for x in fun_result.inner.values()])):
+            full_diff and any(x.diff for x in fun_result.inner.values())):
         if output_dir:
             output = open(os.path.join(output_dir, "{}.diff".format(fun)), "w")
             output.write(
@@ -5,9 +5,56 @@ from diffkemp.llvm_ir.compiler import get_clang_default_options
 from diffkemp.llvm_ir.llvm_module import LlvmModule
 from diffkemp.llvm_ir.llvm_source_finder import LlvmSourceFinder, \
     SourceNotFoundException
-from diffkemp.llvm_ir.optimiser import opt_llvm, BuildException
+from diffkemp.llvm_ir.optimiser import opt_llvm, BuildException, \
+    OPT_PASSES
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
 import os
-from subprocess import check_call, check_output, CalledProcessError
+import re
+import shlex
+import shutil
+import tempfile
+import threading
+from subprocess import check_call, check_output, run, CalledProcessError, \
+    DEVNULL, PIPE, Popen, TimeoutExpired
+
+# Directory for caching LLVM IR files built from kernel sources
+LLVM_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "diffkemp", "llvm")
+# Version of the format of the cached LLVM IR files, must be increased
+# whenever the way of building the files changes
+LLVM_CACHE_VERSION = 1
+# Environment variable setting the maximal size of the LLVM IR cache in MiB,
+# the cache is disabled unless the variable is set to a positive size
+LLVM_CACHE_SIZE_VAR = "DIFFKEMP_LLVM_CACHE_SIZE"
+LLVM_CACHE_DEFAULT_SIZE = 0
+
+# Files scanned by cscope and directories excluded from the scanning
+CSCOPE_FILE_EXTS = frozenset([".c", ".h", ".x", ".s", ".S"])
+CSCOPE_EXCLUDED_DIRS = frozenset(["Documentation", "scripts"])
+
+# GCC parameters that are not passed to Clang when converting Kbuild commands
+GCC_SKIPPED_PARAMS = frozenset(["gcc", "-DCC_HAVE_ASM_GOTO", "-g", "-o"])
+GCC_SKIPPED_PREFIXES = ("-f", "-m", "-O")
+
+# Prefixes of symbols created by a macro in kernel/params.c
+PARAM_SYMBOL_PREFIXES = ("param_get_", "param_set_", "param_ops_")
+
+# Prompt printed by cscope in the line-oriented mode
+CSCOPE_PROMPT = ">> "
+
+# Rewrites of kernel compiler headers disabling asm features that are not
+# supported by older versions of LLVM
+ASM_GOTO = b"asm goto(x)"
+ASM_GOTO_DISABLED = b'asm ("goto(" #x ")")'
+ASM_INLINE_UNDEF = b"#undef CONFIG_CC_HAS_ASM_INLINE // DiffKemp generated\n"
+ASM_INLINE_IFDEF_RE = re.compile(
+    rb"^(?=.*#ifdef CONFIG_CC_HAS_ASM_INLINE)", flags=re.MULTILINE)
+ASM_INLINE_UNDEF_RE = re.compile(
+    rb"^.*" + re.escape(ASM_INLINE_UNDEF.rstrip()) + rb".*\n?",
+    flags=re.MULTILINE)
 
 
 class KernelLlvmSourceBuilder(LlvmSourceFinder):
@@ -19,7 +66,17 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
     """
     def __init__(self, source_dir):
         LlvmSourceFinder.__init__(self, source_dir)
+        # Prefix for creating absolute paths from paths relative to the kernel
+        # directory (cheaper than calling os.path.join in loops)
+        self.source_dir_prefix = os.path.join(self.source_dir, "")
+        # Results of cscope queries, persisted across runs in a file stored
+        # in the kernel directory
         self.cscope_cache = dict()
+        self.cscope_cache_file = os.path.join(self.source_dir,
+                                              ".diffkemp_cscope_cache.json")
+        self._load_cscope_cache()
+        # Running cscope process used for searching symbols
+        self.cscope_process = None
         # Compiler headers (containing 'asm goto' constructions)
         self.compiler_headers = [os.path.join(self.source_dir, h) for h in
                                  ["include/linux/compiler-gcc.h",
@@ -28,6 +85,17 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
         self.initialize()
         # Caching built modules to reuse them
         self.built_modules = dict()
+        # Caching Kbuild commands for building object files (pre-filled from
+        # the compilation database if the kernel has one)
+        self.kbuild_object_commands = self._load_compile_commands()
+        # Sources may be built in parallel, however, running make in the
+        # kernel directory for finding the Kbuild commands must be serialized
+        self.kbuild_lock = threading.Lock()
+        # Maximal size of the LLVM IR cache in bytes (0 if disabled)
+        self.llvm_cache_size = self._llvm_cache_size()
+        # Versions of Clang and opt (used in hashes of cached LLVM IR files)
+        self.clang_version = None
+        self.opt_version = None
 
     ######################################################################
     # Implementation of methods from the LlvmSourceFinder abstract class #
@@ -48,6 +116,9 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
     def finalize(self):
         """Restore the kernel state."""
         self._enable_asm_features()
+        self._cscope_stop()
+        self._store_cscope_cache()
+        self._prune_llvm_cache()
 
     def find_llvm_with_symbol_def(self, symbol):
         """
@@ -64,7 +135,7 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
         srcs = self._find_srcs_with_symbol_def(symbol)
         for src in srcs:
             try:
-                source_path = os.path.join(self.source_dir, src)
+                source_path = self.source_dir_prefix + src
                 llvm_filename = self._build_source_to_llvm(source_path)
                 if os.path.isfile(llvm_filename):
                     mod = LlvmModule(llvm_filename)
@@ -82,29 +153,31 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
         :param symbol: Symbol to find.
         :return Set of source files containing functions that use the symbol.
         """
-        cwd = os.getcwd()
-        os.chdir(self.source_dir)
-        try:
-            cscope_out = self._cscope_run(symbol, definition=False)
-            if len(cscope_out) == 0:
-                raise SourceNotFoundException
-            files = set()
-            for line in cscope_out:
-                if line.split()[0].endswith(".h"):
-                    continue
-                if line.split()[1] == "<global>":
-                    continue
+        cscope_out = self._cscope_run(symbol, definition=False)
+        if len(cscope_out) == 0:
+            raise SourceNotFoundException
+        sources = set()
+        for line in cscope_out:
+            source, scope = line.split(maxsplit=2)[:2]
+            if source.endswith(".h") or scope == "<global>":
+                continue
+            sources.add(source)
+        self._prepare_builds(sources)
+        # Sources are independent of each other, so they can be built in
+        # parallel.
+        files = set()
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            builds = [pool.submit(self._build_source_to_llvm, src)
+                      for src in sources]
+            for build in as_completed(builds):
                 try:
-                    llvm_filename = self._build_source_to_llvm(line.split()[0])
+                    llvm_filename = os.path.join(self.source_dir,
+                                                 build.result())
                     if os.path.isfile(llvm_filename):
-                        files.add(os.path.join(self.source_dir, llvm_filename))
+                        files.add(llvm_filename)
                 except BuildException:
                     pass
-            return files
-        except SourceNotFoundException:
-            raise
-        finally:
-            os.chdir(cwd)
+        return files
 
     def find_llvm_for_kernel_module(self, mod_dir, mod_name):
         """
@@ -118,49 +191,53 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
         llvm_file = self._build_kernel_mod_to_llvm(mod_dir, mod_name)
         return os.path.join(self.source_dir, llvm_file)
 
-    def _disable_asm_features(self):
+    def _rewrite_compiler_headers(self, rewrite):
         """
-        Disable asm features that are not supported by older versions of LLVM.
-        - transform 'asm goto(x)' command into 'asm("goto(x)")'
-        - disable usage of 'asm inline'
+        Rewrite the contents of all existing compiler headers.
+        The new contents are written into a temporary file which then replaces
+        the header so that an interrupted rewrite never leaves a truncated
+        header behind.
+        :param rewrite: Function transforming the original header contents
+                        (as bytes) into the new contents.
         """
         for header in self.compiler_headers:
             if not os.path.isfile(header):
                 continue
-            commands = [
-                ["sed", "-i", "s/asm goto(x)/asm (\"goto(\" #x \")\")/g",
-                 header],
-                ["sed", "-i",
-                 "/#ifdef CONFIG_CC_HAS_ASM_INLINE/i "
-                 "#undef CONFIG_CC_HAS_ASM_INLINE \\/\\/ DiffKemp generated",
-                 header],
-            ]
+            tmp_file = None
             try:
-                with open(os.devnull, "w") as devnull:
-                    for command in commands:
-                        check_call(command, stderr=devnull)
-            except CalledProcessError:
-                pass
+                with open(header, "rb") as header_file:
+                    content = header_file.read()
+                new_content = rewrite(content)
+                if new_content == content:
+                    continue
+                fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(header))
+                with os.fdopen(fd, "wb") as tmp_header:
+                    tmp_header.write(new_content)
+                shutil.copymode(header, tmp_file)
+                os.replace(tmp_file, header)
+            except OSError:
+                if tmp_file is not None and os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+
+    def _disable_asm_features(self):
+        """
+        Disable asm features that are not supported by older versions of LLVM.
+        - transform 'asm goto(x)' command into 'asm("goto(x)")'
+        - disable usage of 'asm inline'
+        """
+        def rewrite(content):
+            content = content.replace(ASM_GOTO, ASM_GOTO_DISABLED)
+            return ASM_INLINE_IFDEF_RE.sub(ASM_INLINE_UNDEF, content)
+
+        self._rewrite_compiler_headers(rewrite)
 
     def _enable_asm_features(self):
         """Restore the original 'asm goto' and 'asm inline' semantics."""
-        for header in self.compiler_headers:
-            if not os.path.isfile(header):
-                continue
-            commands = [
-                ["sed", "-i", "s/asm (\"goto(\" #x \")\")/asm goto(x)/g",
-                 header],
-                ["sed", "-i",
-                 "/#undef CONFIG_CC_HAS_ASM_INLINE "
-                 "\\/\\/ DiffKemp generated/d",
-                 header],
-            ]
-            try:
-                with open(os.devnull, "w") as devnull:
-                    for command in commands:
-                        check_call(command, stderr=devnull)
-            except CalledProcessError:
-                pass
+        def rewrite(content):
+            content = content.replace(ASM_GOTO_DISABLED, ASM_GOTO)
+            return ASM_INLINE_UNDEF_RE.sub(b"", content)
+
+        self._rewrite_compiler_headers(rewrite)
 
     ###################################################
     # Methods for finding C source files using CScope #
@@ -176,29 +253,187 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
         if os.path.isfile(cscope_path):
             return
 
+        # Collect all files that need to be scanned. Directories that are
+        # not searched are pruned before descending into them.
+        paths = []
+        dirs = [(self.source_dir, "")]
+        while dirs:
+            dir_path, rel_prefix = dirs.pop()
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if (entry.name not in CSCOPE_EXCLUDED_DIRS and
+                                not entry.name.startswith("tmp")):
+                            dirs.append((entry.path,
+                                         rel_prefix + entry.name + "/"))
+                    elif (entry.is_file(follow_symlinks=False) and
+                          os.path.splitext(entry.name)[1] in CSCOPE_FILE_EXTS):
+                        paths.append(rel_prefix + entry.name + "\n")
+
         # Write all files that need to be scanned into cscope.files
         with open(cscope_path, "w") as cscope_file:
-            for root, dirs, files in os.walk(self.source_dir):
-                if ("/Documentation/" in root or
-                        "/scripts/" in root or
-                        "/tmp" in root):
-                    continue
-
-                for f in files:
-                    if os.path.islink(os.path.join(root, f)):
-                        continue
-                    if f.endswith((".c", ".h", ".x", ".s", ".S")):
-                        path = os.path.relpath(os.path.join(root, f),
-                                               self.source_dir)
-                        cscope_file.write("{}\n".format(path))
+            cscope_file.writelines(paths)
 
         # Build cscope database
         try:
             check_call(["cscope", "-b", "-q", "-k"], cwd=self.source_dir)
+        except OSError:
+            os.remove(cscope_path)
+            raise
         except CalledProcessError:
             os.remove(cscope_path)
             raise BuildException("Error building cscope database")
 
+    def _load_cscope_cache(self):
+        """
+        Load results of cscope queries stored by previous runs. The stored
+        results are used only if the cscope database has not been changed
+        since they were stored.
+        """
+        cscope_db = os.path.join(self.source_dir, "cscope.out")
+        try:
+            with open(self.cscope_cache_file, "r") as cache_file:
+                stored = json.load(cache_file)
+            if stored["cscope_mtime"] == os.path.getmtime(cscope_db):
+                # JSON has no tuples, queries are stored as lists
+                self.cscope_cache = {
+                    (symbol, bool(definition)): list(lines)
+                    for symbol, definition, lines in stored["queries"]}
+        except (OSError, ValueError, TypeError, KeyError):
+            pass
+
+    def _store_cscope_cache(self):
+        """
+        Store results of cscope queries so that they can be reused by
+        subsequent runs. The results are tagged with the modification time of
+        the cscope database to detect when they become outdated.
+        """
+        cscope_db = os.path.join(self.source_dir, "cscope.out")
+        if not self.cscope_cache or not os.path.isfile(cscope_db):
+            return
+        stored = {
+            "cscope_mtime": os.path.getmtime(cscope_db),
+            "queries": [[symbol, definition, lines] for
+                        (symbol, definition), lines in
+                        self.cscope_cache.items()]
+        }
+        try:
+            with open(self.cscope_cache_file, "w") as cache_file:
+                json.dump(stored, cache_file)
+        except OSError:
+            pass
+
+    def _cscope_start(self):
+        """
+        Start a cscope process in the line-oriented mode. The process is kept
+        running so that multiple searches can be done without spawning a new
+        cscope process for each of them.
+        """
+        self._build_cscope_database()
+        self.cscope_process = Popen(["cscope", "-d", "-l"],
+                                    cwd=self.source_dir,
+                                    stdin=PIPE, stdout=PIPE, stderr=DEVNULL,
+                                    encoding="utf-8", errors="replace")
+        # Consume the initial prompt
+        self.cscope_process.stdout.read(len(CSCOPE_PROMPT))
+
+    def _cscope_stop(self):
+        """Terminate the running cscope process (if there is one)."""
+        if self.cscope_process is None:
+            return
+        try:
+            self.cscope_process.communicate("q\n", timeout=5)
+        except (OSError, ValueError, TimeoutExpired):
+            self.cscope_process.kill()
+            self.cscope_process.wait()
+        self.cscope_process = None
+
+    def _cscope_query(self, symbol, definition):
+        """
+        Run a single search in the running cscope process.
+        :param symbol: Symbol to search for
+        :param definition: If true, search definitions, otherwise search all
+                           usage.
+        :return: List of lines output by cscope or None if the search failed.
+        """
+        if self.cscope_process is None:
+            self._cscope_start()
+        process = self.cscope_process
+        try:
+            process.stdin.write("{}{}\n".format(1 if definition else 0,
+                                                symbol))
+            process.stdin.flush()
+            # The output starts with a header "cscope: <N> lines" followed by
+            # N lines of results and by a prompt for the next search.
+            header = self._cscope_read_header(process)
+            if header is None:
+                # The process has terminated
+                self._cscope_stop()
+                return None
+            if not header:
+                # No header was printed, the prompt has already been read
+                return None
+            if not header.startswith("cscope: "):
+                process.stdout.read(len(CSCOPE_PROMPT))
+                return None
+            lines = []
+            for _ in range(int(header.split()[1])):
+                line = process.stdout.readline()
+                if not line:
+                    # The process has terminated in the middle of the output
+                    self._cscope_stop()
+                    return None
+                lines.append(line.rstrip("\n"))
+            process.stdout.read(len(CSCOPE_PROMPT))
+            return lines
+        except (OSError, ValueError, IndexError):
+            self._cscope_stop()
+            return None
+
+    @staticmethod
+    def _cscope_read_header(process):
+        """
+        Read the first line of the output of a cscope search. The line is read
+        by characters so that reading does not block when the search outputs
+        just the prompt (which is not followed by a newline).
+        :return: The read line, an empty string if the prompt was read instead,
+                 or None if the process has terminated.
+        """
+        header = ""
+        while not header.endswith("\n"):
+            char = process.stdout.read(1)
+            if not char:
+                return None
+            header += char
+            if header == CSCOPE_PROMPT:
+                return ""
+        return header
+
+    def _cscope_run_batch(self, queries):
+        """
+        Run multiple cscope searches using a single cscope process.
+        :param queries: List of pairs (symbol, definition) where definition
+                        says whether to search definitions or all usage of
+                        the symbol.
+        :return: Dictionary mapping each query to the list of found cscope
+                 entries.
+        """
+        result = dict()
+        for query in queries:
+            cached = self.cscope_cache.get(query)
+            if cached is not None:
+                result[query] = cached
+                continue
+
+            lines = self._cscope_query(*query)
+            if lines is None:
+                result[query] = []
+                continue
+            result[query] = [line for line in lines if
+                             line.split(maxsplit=1)[0].endswith("c")]
+            self.cscope_cache[query] = result[query]
+        return result
+
     def _cscope_run(self, symbol, definition):
         """
         Run cscope search for a symbol.
@@ -207,23 +442,8 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
                            usage.
         :return: List of found cscope entries.
         """
-        cached = self.cscope_cache.get((symbol, definition))
-        if cached is not None:
-            return cached
-
-        self._build_cscope_database()
-        try:
-            command = ["cscope", "-d", "-L", "-1" if definition else "-0",
-                       symbol]
-            with open(os.devnull, "w") as devnull:
-                cscope_output = check_output(command, stderr=devnull).decode(
-                    'utf-8')
-            result = [line for line in cscope_output.splitlines() if
-                      line.split()[0].endswith("c")]
-            self.cscope_cache[(symbol, definition)] = result
-            return result
-        except CalledProcessError:
-            return []
+        return self._cscope_run_batch([(symbol, definition)])[
+            (symbol, definition)]
 
     def _find_tracepoint_macro_use(self, symbol):
         """
@@ -242,23 +462,22 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
         :param symbol: Symbol to find.
         :return List of source files potentially containing the definition.
         """
-        cwd = os.getcwd()
-        os.chdir(self.source_dir)
         try:
-            cscope_defs = self._cscope_run(symbol, True)
-
-            # It may not be enough to get the definitions from the cscope.
-            # There are multiple possible reasons:
+            # It may not be enough to get the definitions from the cscope,
+            # usages of the symbol are searched, too. There are multiple
+            # possible reasons:
             #   - the symbol is only defined in headers
             #   - there is a bug in cscope - it cannot find definitions
             #     containing function pointers as parameters
-            cscope_uses = self._cscope_run(symbol, False)
+            cscope_out = self._cscope_run_batch([(symbol, True),
+                                                 (symbol, False)])
+            cscope_defs = cscope_out[(symbol, True)]
+            cscope_uses = cscope_out[(symbol, False)]
 
             # Look whether this is one of the special cases when cscope does
             # not find a correct source because of the exact symbol being
             # created by the preprocessor
-            if any([symbol.startswith(s) for s in
-                    ["param_get_", "param_set_", "param_ops_"]]):
+            if symbol.startswith(PARAM_SYMBOL_PREFIXES):
                 # Symbol param_* are created in kernel/params.c using a macro
                 cscope_defs = ["kernel/params.c"] + cscope_defs
             elif symbol.startswith("__tracepoint_"):
@@ -278,8 +497,6 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
                 cscope_defs = ["mm/vmalloc.c"]
             else:
                 raise
-        finally:
-            os.chdir(cwd)
 
         # We now create a list of files potentially containing the file
         # definition. The list is sorted by priority:
@@ -290,47 +507,54 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
         # the arch/ directories occur later than the others (using prio_key).
         # Moreover, each file occurs in the list just once (in place of its
         # highest priority).
-        seen = set()
-
         def prio_key(item):
             if item.startswith("drivers/"):
-                return "}" + item
+                return 1, item
             if item.startswith("arch/x86"):
                 # x86 has priority over other architectures
-                return "}}" + item
+                return 2, item
             if item.startswith("arch/"):
-                return "}}}" + item
+                return 3, item
+            else:
+                return 0, item
+
+        seen = set()
+        defs = []
+        for line in cscope_defs:
+            f = line.split(None, 1)[0]
+            if f not in seen:
+                seen.add(f)
+                defs.append(f)
+        global_uses = []
+        other_uses = []
+        for line in cscope_uses:
+            f, scope = line.split(None, 2)[:2]
+            if scope == "<global>":
+                global_uses.append(f)
             else:
-                return item
-
-        files = sorted(
-            [f for f in [line.split()[0] for line in cscope_defs]
-             if not (f in seen or seen.add(f))],
-            key=prio_key)
-        files.extend(sorted(
-            [f for (f, scope) in [(line.split()[0], line.split()[1])
-                                  for line in cscope_uses]
-             if (scope == "<global>" and not (f in seen or seen.add(f)))],
-            key=prio_key))
-        files.extend(sorted(
-            [f for (f, scope) in [(line.split()[0], line.split()[1])
-                                  for line in cscope_uses]
-             if (scope != "<global>" and not (f in seen or seen.add(f)))],
-            key=prio_key))
+                other_uses.append(f)
+        files = sorted(defs, key=prio_key)
+        for group in [global_uses, other_uses]:
+            group_files = []
+            for f in group:
+                if f not in seen:
+                    seen.add(f)
+                    group_files.append(f)
+            files.extend(sorted(group_files, key=prio_key))
         return files
 
     #################################################
     # Methods for building C source files into LLVM #
     #################################################
     @staticmethod
-    def _strip_bash_quotes(gcc_param):
+    def _split_command(command):
         """
-        Remove quotes from gcc_param that represents a part of a shell command.
+        Split a shell command into a list of parameters with quotes removed.
         """
-        if "\'" in gcc_param:
-            return gcc_param.replace("\'", "")
-        else:
-            return gcc_param.replace("\"", "")
+        try:
+            return shlex.split(command)
+        except ValueError:
+            raise BuildException("Cannot parse command: {}".format(command))
 
     @staticmethod
     def _gcc_to_llvm(gcc_command):
@@ -343,31 +567,26 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
         output_file = None
         command = ["clang"]
         command.extend(get_clang_default_options())
-        for param in gcc_command.split():
-            if (param == "gcc" or
+        for param in KernelLlvmSourceBuilder._split_command(gcc_command):
+            if (param in GCC_SKIPPED_PARAMS or
+                    param.startswith(GCC_SKIPPED_PREFIXES) or
                     (param.startswith("-W") and "-MD" not in param) or
-                    param.startswith("-f") or
-                    param.startswith("-m") or
-                    param.startswith("-O") or
-                    param == "-DCC_HAVE_ASM_GOTO" or
-                    param == "-g" or
-                    param == "-o" or
                     param.endswith(".o")):
                 continue
 
             # Do not use generated debug hashes.
             # Note: they are used for debugging purposes only and cause false
             # positives in SimpLL.
-            if param.startswith('-D"DEBUG_HASH='):
-                param = '-D"DEBUG_HASH=1"'
-            if param.startswith('-D"DEBUG_HASH2='):
-                param = '-D"DEBUG_HASH2=1"'
+            if param.startswith("-DDEBUG_HASH="):
+                param = "-DDEBUG_HASH=1"
+            if param.startswith("-DDEBUG_HASH2="):
+                param = "-DDEBUG_HASH2=1"
 
             # Output name is given by replacing .c by .ll in source name
             if param.endswith(".c"):
                 output_file = "{}.ll".format(param[:-2])
 
-            command.append(KernelLlvmSourceBuilder._strip_bash_quotes(param))
+            command.append(param)
         if output_file is None:
             raise BuildException("Build error: gcc command not compiling C \
                                  source found")
@@ -383,7 +602,7 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
         :return Corresponding llvm-link command.
         """
         command = ["llvm-link", "-S"]
-        for param in ld_command.split():
+        for param in KernelLlvmSourceBuilder._split_command(ld_command):
             if param.endswith(".o"):
                 command.append("{}.ll".format(param[:-2]))
             elif param == "-o":
@@ -417,9 +636,11 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
         Extract a single command running one of the specified programs from
         a list of commands separated by ;.
         """
+        programs = tuple(programs)
         for c in command.split(";"):
-            if any([c.lstrip().startswith(prog) for prog in programs]):
-                return c.lstrip()
+            c = c.lstrip()
+            if c.startswith(programs):
+                return c
         return None
 
     @staticmethod
@@ -427,7 +648,7 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
         """
         Extract a single gcc command from a list of commands separated by ;.
         """
-        return KernelLlvmSourceBuilder._extract_command(command, ["gcc"])
+        return KernelLlvmSourceBuilder._extract_command(command, ("gcc",))
 
     @staticmethod
     def _extract_gcc_or_ld_command(command):
@@ -435,7 +656,7 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
         Extract a single gcc or ld command from a list of commands separated
         by ;.
         """
-        return KernelLlvmSourceBuilder._extract_command(command, ["gcc", "ld"])
+        return KernelLlvmSourceBuilder._extract_command(command, ("gcc", "ld"))
 
     @staticmethod
     def _extract_gcc_or_ld_command_list(commands):
@@ -465,28 +686,103 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
         :returns GCC command used for the compilation. This is the last
                  command starting with 'gcc' that was run by make
         """
-        cwd = os.getcwd()
-        os.chdir(self.source_dir)
-        self._clean_object(object_file)
-        with open(os.devnull, "w") as stderr:
-            try:
-                output = check_output(
-                    ["make", "V=1",
-                     "CFLAGS=-w", "EXTRA_CFLAGS=-w",
-                     object_file,
-                     "--just-print"], stderr=stderr).decode("utf-8")
-            except CalledProcessError:
-                raise BuildException("Error compiling {}".format(object_file))
-            finally:
-                os.chdir(cwd)
+        cached = self.kbuild_object_commands.get(object_file)
+        if cached is not None:
+            return cached
+
+        with self.kbuild_lock:
+            # The command may have been found while waiting for the lock
+            cached = self.kbuild_object_commands.get(object_file)
+            if cached is not None:
+                return cached
+
+            self._clean_object(os.path.join(self.source_dir, object_file))
+            with open(os.devnull, "w") as stderr:
+                try:
+                    output = check_output(
+                        ["make", "V=1",
+                         "CFLAGS=-w", "EXTRA_CFLAGS=-w",
+                         object_file,
+                         "--just-print"],
+                        cwd=self.source_dir, stderr=stderr).decode("utf-8")
+                except CalledProcessError:
+                    raise BuildException(
+                        "Error compiling {}".format(object_file))
 
         for c in reversed(output.splitlines()):
             command = self._extract_gcc_command(c)
             if command:
+                self.kbuild_object_commands[object_file] = command
                 return command
         raise BuildException("Compiling {} did not run a gcc command".format(
             object_file))
 
+    def _load_compile_commands(self):
+        """
+        Load commands used to build object files from the compilation database
+        (compile_commands.json) if it exists in the kernel directory. Objects
+        found in the database do not need to be looked up by running make.
+        :returns Dictionary mapping object files to GCC commands used for their
+                 compilation.
+        """
+        db_path = os.path.join(self.source_dir, "compile_commands.json")
+        try:
+            with open(db_path, "r") as db_file:
+                entries = json.load(db_file)
+        except (OSError, ValueError):
+            return dict()
+
+        commands = dict()
+        for entry in entries:
+            if not isinstance(entry, dict) or "command" not in entry:
+                continue
+            command = self._extract_gcc_command(entry["command"])
+            if not command:
+                continue
+            sources = [p for p in command.split() if p.endswith(".c")]
+            if sources:
+                commands["{}.o".format(sources[-1][:-2])] = command
+        return commands
+
+    def _kbuild_object_commands(self, object_files):
+        """
+        Check which commands would be run by KBuild to build the given object
+        files. All the objects are passed to a single make invocation so that
+        Kbuild needs to evaluate the build only once.
+        The command used is `make V=1 -k --just-print path/to/a.o path/to/b.o`
+        :param object_files: List of object files relative to the kernel
+                             directory.
+        :returns Dictionary mapping object files to GCC commands used for their
+                 compilation. Objects whose command was not found are not
+                 included.
+        """
+        if not object_files:
+            return dict()
+
+        for obj in object_files:
+            self._clean_object(self.source_dir_prefix + obj)
+        # If some of the objects cannot be built, make fails. However, thanks
+        # to -k, the commands for the other objects are still printed.
+        with open(os.devnull, "w") as stderr:
+            output = run(["make", "V=1", "-k",
+                          "CFLAGS=-w", "EXTRA_CFLAGS=-w"] +
+                         object_files + ["--just-print"],
+                         cwd=self.source_dir, stdout=PIPE,
+                         stderr=stderr).stdout.decode("utf-8")
+
+        # Assign each gcc command to the object built from its source. If
+        # there are more commands for a single object, the last one is used.
+        objects = {"{}.c".format(obj[:-2]): obj for obj in object_files}
+        commands = dict()
+        for c in output.splitlines():
+            command = self._extract_gcc_command(c)
+            if not command:
+                continue
+            sources = [p for p in command.split() if p.endswith(".c")]
+            if sources and sources[-1] in objects:
+                commands[objects[sources[-1]]] = command
+        return commands
+
     def _kbuild_module_commands(self, mod_dir, mod_name):
         """
         Build a kernel module using Kbuild.
@@ -498,15 +794,12 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
                  List of commands that were used to compile and link files in
                  the module.
         """
-        cwd = os.getcwd()
-        os.chdir(self.source_dir)
-
         file_name = mod_name
         command = ["make", "--just-print", "V=1", "M={}".format(mod_dir),
                    "{}.ko".format(mod_name)]
 
         try:
-            output = check_output(command).decode("utf-8")
+            output = check_output(command, cwd=self.source_dir).decode("utf-8")
             return file_name, \
                 self._extract_gcc_or_ld_command_list(output.splitlines())
         except CalledProcessError as e:
@@ -516,18 +809,199 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
                 file_name = file_name.replace("_", "-")
                 command[4] = "{}.ko".format(file_name)
                 try:
-                    output = check_output(command).decode("utf-8")
+                    output = check_output(command,
+                                          cwd=self.source_dir).decode("utf-8")
                     return file_name, self._extract_gcc_or_ld_command_list(
                         output.splitlines())
                 except CalledProcessError:
                     raise BuildException(
                         "Could not build module {}".format(mod_name))
-                finally:
-                    os.chdir(cwd)
-        finally:
-            os.chdir(cwd)
         raise BuildException("Could not build module {}".format(mod_name))
 
+    def _relative_path(self, path):
+        """
+        Get the path relative to the kernel directory. Paths inside the kernel
+        directory only need the directory prefix to be removed.
+        """
+        if path.startswith(self.source_dir_prefix):
+            return path[len(self.source_dir_prefix):]
+        return os.path.relpath(path, self.source_dir)
+
+    def _prepare_builds(self, source_files):
+        """
+        Find Kbuild commands for building all the given sources that need to
+        be (re)built into LLVM IR at once. The sources can be then built
+        independently of each other without running make for each of them.
+        :param source_files: List of C sources to build.
+        """
+        object_files = []
+        for source_file in source_files:
+            if source_file in self.built_modules:
+                continue
+            source_path = os.path.join(self.source_dir, source_file)
+            llvm_path = "{}.ll".format(source_path[:-2])
+            if (os.path.isfile(llvm_path) and os.path.isfile(source_path) and
+                    os.path.getmtime(llvm_path) >=
+                    os.path.getmtime(source_path)):
+                continue
+            name = self._relative_path(source_path)[:-2]
+            object_file = "{}.o".format(name)
+            if object_file not in self.kbuild_object_commands:
+                object_files.append(object_file)
+        self.kbuild_object_commands.update(
+            self._kbuild_object_commands(object_files))
+
+    @staticmethod
+    def _llvm_cache_size():
+        """
+        Get the maximal size of the LLVM IR cache (in bytes) as set by the
+        DIFFKEMP_LLVM_CACHE_SIZE environment variable (in MiB).
+        """
+        try:
+            size = int(os.environ.get(LLVM_CACHE_SIZE_VAR,
+                                      LLVM_CACHE_DEFAULT_SIZE))
+        except ValueError:
+            size = LLVM_CACHE_DEFAULT_SIZE
+        return max(size, 0) * 1024 * 1024
+
+    def _get_dependencies(self, command):
+        """
+        Get the files the source built by a Clang command depends on (the
+        source itself and all the included headers) from the dependency file
+        written by the last run of the command ('-Wp,-MD,<file>' passed from
+        Kbuild).
+        :param command: Clang command building the LLVM IR.
+        :return: List of absolute paths of the dependencies or None if the
+                 dependency file does not exist.
+        """
+        depfile = None
+        for param in command:
+            if param.startswith("-Wp,"):
+                options = param.split(",")
+                for i, option in enumerate(options[:-1]):
+                    if option in ["-MD", "-MMD"]:
+                        depfile = options[i + 1]
+        if depfile is None:
+            return None
+        try:
+            with open(os.path.join(self.source_dir, depfile), "r") as deps:
+                content = deps.read()
+        except OSError:
+            return None
+        # The file contains a single make rule "target: dep1 dep2 \"
+        # possibly split into multiple lines.
+        _, _, dependencies = content.replace("\\\n", " ").partition(":")
+        return [os.path.join(self.source_dir, dep)
+                for dep in dependencies.split()]
+
+    def _llvm_cache_file(self, command):
+        """
+        Get the file in the LLVM IR cache corresponding to a Clang command.
+        The name of the file is a hash of the command, of the contents of all
+        files listed in the dependency file of the last build (the source and
+        all included headers), of the Clang and opt versions, of the opt
+        passes, and of the cache format version. The kernel directory is
+        a part of the hash, too, since the built IR contains absolute paths in
+        its debug info.
+        As long as the command and the listed files do not change, the set of
+        included files cannot change either, so a dependency file left by an
+        older build can be used for the lookup. Before the first build of the
+        source, there is no dependency file and the cache is not used.
+        :param command: Clang command building the LLVM IR.
+        :return: Path to the cache file or None if it cannot be determined or
+                 the cache is disabled.
+        """
+        if self.llvm_cache_size == 0:
+            return None
+        dependencies = self._get_dependencies(command)
+        if not dependencies:
+            return None
+        digest = hashlib.blake2b()
+        try:
+            for dependency in dependencies:
+                digest.update(dependency.encode("utf-8"))
+                digest.update(b"\0")
+                with open(dependency, "rb") as dependency_file:
+                    digest.update(hashlib.blake2b(
+                        dependency_file.read()).digest())
+            with open(os.devnull, "w") as stderr:
+                if self.clang_version is None:
+                    self.clang_version = check_output(["clang", "--version"],
+                                                      stderr=stderr)
+                if self.opt_version is None:
+                    self.opt_version = check_output(["opt", "--version"],
+                                                    stderr=stderr)
+            os.makedirs(LLVM_CACHE_DIR, exist_ok=True)
+        except (CalledProcessError, OSError):
+            return None
+
+        for part in [str(LLVM_CACHE_VERSION).encode("utf-8"),
+                     self.clang_version, self.opt_version,
+                     repr(OPT_PASSES).encode("utf-8"),
+                     self.source_dir.encode("utf-8"),
+                     " ".join(command).encode("utf-8")]:
+            digest.update(part)
+            digest.update(b"\0")
+        return os.path.join(LLVM_CACHE_DIR, "{}.ll".format(digest.hexdigest()))
+
+    @staticmethod
+    def _store_to_llvm_cache(llvm_file, cache_file):
+        """
+        Store a built LLVM IR file into the cache. The file is first copied
+        under a temporary name and then renamed so that concurrent builds never
+        see a partially written cache file.
+        """
+        try:
+            fd, tmp_file = tempfile.mkstemp(dir=LLVM_CACHE_DIR)
+            os.close(fd)
+            shutil.copyfile(llvm_file, tmp_file)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _load_from_llvm_cache(cache_file, llvm_file):
+        """
+        Copy a cached LLVM IR file into the kernel directory.
+        :return: True if the file was found in the cache, False otherwise
+                 (including the case when the file was removed from the cache
+                 concurrently).
+        """
+        try:
+            shutil.copyfile(cache_file, llvm_file)
+            # Mark the file as recently used so that it is not pruned
+            os.utime(cache_file)
+        except OSError:
+            return False
+        return True
+
+    def _prune_llvm_cache(self):
+        """
+        Remove the least recently used files from the LLVM IR cache until its
+        size fits into the limit.
+        """
+        if self.llvm_cache_size == 0:
+            return
+        try:
+            with os.scandir(LLVM_CACHE_DIR) as entries:
+                files = []
+                for entry in entries:
+                    if entry.name.endswith(".ll"):
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size,
+                                      entry.path))
+        except OSError:
+            return
+        total_size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total_size <= self.llvm_cache_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+
     def _build_source_to_llvm(self, source_file):
         """
         Build C source file into LLVM IR.
@@ -536,34 +1010,91 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
         :param source_file: C source to build
         :return: Created LLVM IR file
         """
-        llvm_file = "{}.ll".format(source_file[:-2])
-        if (not os.path.isfile(llvm_file) or os.path.getmtime(llvm_file) <
-                os.path.getmtime(source_file)):
-            cwd = os.getcwd()
-            os.chdir(self.source_dir)
+        # Sources that were already built during this run are up-to-date
+        cached = self.built_modules.get(source_file)
+        if cached is not None:
+            return cached
 
-            name = os.path.relpath(source_file, self.source_dir)[:-2]
-            try:
-                # Get GCC command for building the .o file
-                command = self._kbuild_object_command("{}.o".format(name))
-                # Convert the GCC command to a corresponding Clang command
-                command = self._gcc_to_llvm(command)
-                # Run the Clang command
-                with open(os.devnull, "w") as stderr:
-                    try:
-                        check_call(command, stderr=stderr)
-                    except CalledProcessError:
-                        os.chdir(cwd)
-                        raise BuildException(
-                            "Could not build {}".format(llvm_file))
-                # Run opt with selected optimisations
-                opt_llvm(llvm_file)
-            except BuildException:
-                raise
-            finally:
-                os.chdir(cwd)
+        llvm_file = "{}.ll".format(source_file[:-2])
+        source_path = os.path.join(self.source_dir, source_file)
+        llvm_path = os.path.join(self.source_dir, llvm_file)
+        if (not os.path.isfile(llvm_path) or os.path.getmtime(llvm_path) <
+                os.path.getmtime(source_path)):
+            name = self._relative_path(source_path)[:-2]
+            # Get GCC command for building the .o file
+            command = self._kbuild_object_command("{}.o".format(name))
+            # Convert the GCC command to a corresponding Clang command
+            command = self._gcc_to_llvm(command)
+            output_file = os.path.join(self.source_dir, command[-1])
+            # Reuse the LLVM IR built from an identical source
+            cache_file = self._llvm_cache_file(command)
+            if cache_file is not None and \
+                    self._load_from_llvm_cache(cache_file, output_file):
+                self.built_modules[source_file] = llvm_file
+                return llvm_file
+            # Run the Clang command and pipe its output directly into opt
+            # running the selected optimisations. Since opt succeeds even if
+            # Clang fails and produces no output, the result is first written
+            # into a temporary file which replaces the LLVM IR file only if
+            # both commands succeed.
+            clang_command = command[:-1] + ["-"]
+            tmp_file = "{}.tmp".format(output_file)
+            with open(os.devnull, "w") as stderr:
+                try:
+                    clang = Popen(clang_command, cwd=self.source_dir,
+                                  stdout=PIPE, stderr=stderr)
+                except OSError:
+                    raise BuildException(
+                        "Could not build {}".format(llvm_file))
+                try:
+                    opt_llvm(tmp_file, stdin=clang.stdout)
+                except BuildException:
+                    opt_error = True
+                else:
+                    opt_error = False
+                finally:
+                    clang.stdout.close()
+                    clang_error = clang.wait() != 0
+            if clang_error or opt_error:
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+                if clang_error:
+                    raise BuildException(
+                        "Could not build {}".format(llvm_file))
+                raise BuildException("Running opt failed")
+            os.replace(tmp_file, output_file)
+            # The build has updated the dependency file, the cache entry is
+            # determined again from it
+            cache_file = self._llvm_cache_file(command)
+            if cache_file is not None:
+                self._store_to_llvm_cache(output_file, cache_file)
+        self.built_modules[source_file] = llvm_file
         return llvm_file
 
+    @staticmethod
+    def _is_stamp_up_to_date(stamp_file, file):
+        """
+        Check whether a stamp file has the same modification time as the file
+        it belongs to, i.e. the file has not been changed since the stamp was
+        updated.
+        """
+        try:
+            return (os.stat(stamp_file).st_mtime_ns ==
+                    os.stat(file).st_mtime_ns)
+        except OSError:
+            return False
+
+    @staticmethod
+    def _update_stamp(stamp_file, file):
+        """Set the modification time of a stamp file to the one of the file."""
+        try:
+            mtime = os.stat(file).st_mtime_ns
+            with open(stamp_file, "w"):
+                pass
+            os.utime(stamp_file, ns=(mtime, mtime))
+        except OSError:
+            pass
+
     def _build_kernel_mod_to_llvm(self, mod_dir, mod_name):
         """
         Build a kernel module into LLVM IR.
@@ -574,33 +1105,47 @@ class KernelLlvmSourceBuilder(LlvmSourceFinder):
         :param mod_name: Kernel module name.
         :return: Name of the LLVM IR file built.
         """
-        cwd = os.getcwd()
-        os.chdir(self.source_dir)
         try:
             file_name, gcc_commands = self._kbuild_module_commands(mod_dir,
                                                                    mod_name)
             llvm_commands = self._kbuild_to_llvm_commands(gcc_commands,
                                                           file_name)
             with open(os.devnull, "w") as stderr:
-                built = False
+                # Compile all outdated sources in parallel first, linking must
+                # wait until all of them are built.
+                clang_commands = []
                 for c in llvm_commands:
                     if c[0] == "clang":
-                        src = self._get_build_source(c)
-                        obj = self._get_build_object(c)
+                        src = os.path.join(self.source_dir,
+                                           self._get_build_source(c))
+                        obj = os.path.join(self.source_dir,
+                                           self._get_build_object(c))
                         if (not os.path.isfile(obj) or
                                 os.path.getmtime(obj) < os.path.getmtime(src)):
-                            built = True
-                            check_call(c, stderr=stderr)
-                    elif c[0] == "llvm-link":
-                        obj = self._get_build_object(c)
+                            clang_commands.append(c)
+                with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+                    builds = [pool.submit(check_call, c, cwd=self.source_dir,
+                                          stderr=stderr)
+                              for c in clang_commands]
+                    for build in builds:
+                        build.result()
+                built = len(clang_commands) > 0
+                for c in llvm_commands:
+                    if c[0] == "llvm-link":
+                        obj = os.path.join(self.source_dir,
+                                           self._get_build_object(c))
                         if not os.path.isfile(obj) or built:
-                            check_call(c, stderr=stderr)
+                            check_call(c, cwd=self.source_dir, stderr=stderr)
             llvm_file = os.path.join(mod_dir, "{}.ll".format(file_name))
-            opt_llvm(llvm_file)
+            llvm_path = os.path.join(self.source_dir, llvm_file)
+            # Optimise the module unless it has not changed since the last
+            # optimisation
+            stamp_file = "{}.opt-stamp".format(llvm_path)
+            if not self._is_stamp_up_to_date(stamp_file, llvm_path):
+                opt_llvm(llvm_path)
+                self._update_stamp(stamp_file, llvm_path)
             return llvm_file
         except CalledProcessError:
             raise BuildException("Could not build {}".format(mod_name))
         except BuildException:
             raise
-        finally:
-            os.chdir(cwd)
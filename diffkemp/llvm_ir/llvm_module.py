@@ -9,22 +9,33 @@ from diffkemp.utils import get_opt_command
 import os
 import re
 import shutil
-from subprocess import check_call, CalledProcessError
+from subprocess import check_call, CalledProcessError, Popen, PIPE
 
 # Set of standard functions that are supported, so they should not be
 # included in function collecting.
 # Some functions have multiple variants so we need to check for prefix
+# (a tuple, so that all prefixes can be checked by a single str.startswith).
 supported_names = {"llvm.dbg.value", "llvm.dbg.declare"}
-supported_prefixes = {"llvm.lifetime", "kmalloc", "kzalloc", "malloc",
-                      "calloc", "__kmalloc", "devm_kzalloc"}
+supported_prefixes = ("llvm.lifetime", "kmalloc", "kzalloc", "malloc",
+                      "calloc", "__kmalloc", "devm_kzalloc")
+
+
+# Patterns for finding names of functions and global variables defined in
+# a textual LLVM IR file
+FUNCTION_DEF_REGEX = re.compile(rb"^define[^@\n]*@([-\w.$]+)\(",
+                                flags=re.MULTILINE)
+GLOBAL_DEF_REGEX = re.compile(rb"^@([-\w.$]+)\s*=", flags=re.MULTILINE)
+# Pattern for finding source files mentioned in the debug info
+SOURCE_FILE_REGEX = re.compile(rb"filename:\s*\"([^\"]*)\", "
+                               rb"directory:\s*\"([^\"]*)\"")
 
 
 def supported_fun(llvm_fun):
     """Check whether the function is supported."""
-    name = llvm_fun.get_name().decode("utf-8")
+    name = llvm_fun.get_name()
     if name:
         return (name in supported_names or
-                any([name.startswith(p) for p in supported_prefixes]))
+                name.startswith(supported_prefixes))
 
 
 class LlvmParam:
@@ -34,6 +45,8 @@ class LlvmParam:
     The indices correspond to the indices used in LLVM GEP instruction to get
     the address of the particular element within the given variable.
     """
+    __slots__ = ("name", "indices")
+
     def __init__(self, name, indices=None):
         self.name = name
         self.indices = indices
@@ -52,6 +65,18 @@ class LlvmModule:
         self.llvm_module = None
         self.unlinked_llvm = None
         self.linked_modules = set()
+        # Path and modification time of the last created linked LLVM IR file
+        # together with the files (and their modification times) it was
+        # created from, allows to reuse the file if the same modules are
+        # linked again after restoring the unlinked module
+        self.last_link = None
+        # Names of defined functions and global variables and the list of
+        # included sources, collected from the LLVM IR file once needed
+        self.function_defs = None
+        self.global_defs = None
+        self.included_sources = None
+        # Functions (recursively) called by functions of the module
+        self.called_functions = dict()
 
     def parse_module(self, force=False):
         """Parse module file into LLVM module using SimpLL"""
@@ -60,8 +85,31 @@ class LlvmModule:
 
     def clean_module(self):
         """Free the parsed LLVM module."""
-        if self.llvm_module is not None:
-            del self.llvm_module
+        self.llvm_module = None
+
+    def _load_symbol_defs(self):
+        """
+        Collect names of all functions and global variables defined in the
+        LLVM IR file using a single read of the file.
+        """
+        if self.function_defs is not None:
+            return
+        with open(self.llvm, "rb") as llvm_file:
+            text = llvm_file.read()
+        self.function_defs = {name.decode("utf-8") for name in
+                              FUNCTION_DEF_REGEX.findall(text)}
+        self.global_defs = {name.decode("utf-8") for name in
+                            GLOBAL_DEF_REGEX.findall(text)}
+
+    def _reset_file_info(self):
+        """
+        Drop information collected from the LLVM IR file. Must be called when
+        the file changes.
+        """
+        self.function_defs = None
+        self.global_defs = None
+        self.included_sources = None
+        self.called_functions = dict()
 
     @staticmethod
     def clean_all():
@@ -79,23 +127,69 @@ class LlvmModule:
             new_llvm = "{}-linked.ll".format(self.llvm[:-3])
         else:
             new_llvm = self.llvm
-        link_command = ["llvm-link", "-S", self.llvm]
+        # Skip linking if the same modules have already been linked into
+        # the file before and none of the files has been changed since then.
+        linked_modules = self.linked_modules.union(link_llvm_modules)
+        if self.last_link is not None and os.path.isfile(new_llvm) and \
+                self.last_link == self._link_key(linked_modules, new_llvm):
+            self._set_linked_llvm(new_llvm, link_llvm_modules)
+            return True
+        # The linked module is piped into opt as bitcode, only the output of
+        # opt is stored (as text). Since opt succeeds even if llvm-link fails
+        # and produces no output, the result is first written into
+        # a temporary file which replaces the linked module only if both
+        # commands succeed.
+        tmp_llvm = "{}.tmp".format(new_llvm)
+        link_command = ["llvm-link", self.llvm]
         link_command.extend([m.llvm for m in link_llvm_modules])
-        link_command.extend(["-o", new_llvm])
-        opt_command = get_opt_command([("constmerge", "module")], new_llvm)
+        opt_command = get_opt_command([("constmerge", "module")], "-",
+                                      overwrite=False)
+        opt_command.extend(["-S", "-o", tmp_llvm])
         with open(os.devnull, "w") as devnull:
             try:
-                check_call(link_command, stdout=devnull, stderr=devnull)
-                check_call(opt_command, stdout=devnull, stderr=devnull)
-                if self.unlinked_llvm is None:
-                    self.unlinked_llvm = self.llvm
-                self.llvm = new_llvm
-                self.linked_modules.update(link_llvm_modules)
-                self.parse_module(True)
+                link = Popen(link_command, stdout=PIPE, stderr=devnull)
+                try:
+                    check_call(opt_command, stdin=link.stdout,
+                               stdout=devnull, stderr=devnull)
+                finally:
+                    link.stdout.close()
+                    link.wait()
+                if link.returncode != 0:
+                    os.remove(tmp_llvm)
+                    raise CalledProcessError(link.returncode, link_command)
+                os.replace(tmp_llvm, new_llvm)
+                self.last_link = self._link_key(linked_modules, new_llvm)
+                self._set_linked_llvm(new_llvm, link_llvm_modules)
+                return True
             except CalledProcessError:
                 return False
-            finally:
-                return any([m for m in link_llvm_modules if self.links_mod(m)])
+
+    def _link_key(self, linked_modules, linked_llvm):
+        """
+        Identify the result of linking the given modules into this module by
+        the paths and modification times of all the participating files.
+        Modules are identified by their files since a module object may be
+        re-created or its file may be rebuilt between two links.
+        """
+        def file_info(llvm_file):
+            try:
+                return llvm_file, os.stat(llvm_file).st_mtime_ns
+            except OSError:
+                return llvm_file, None
+
+        unlinked_llvm = self.unlinked_llvm or self.llvm
+        return (file_info(unlinked_llvm), file_info(linked_llvm),
+                frozenset(file_info(m.llvm) for m in linked_modules))
+
+    def _set_linked_llvm(self, new_llvm, link_llvm_modules):
+        """Use the given file containing the newly linked modules."""
+        if self.unlinked_llvm is None:
+            self.unlinked_llvm = self.llvm
+        self.llvm = new_llvm
+        self.linked_modules.update(link_llvm_modules)
+        # The linked module is parsed once it is needed
+        self.clean_module()
+        self._reset_file_info()
 
     def find_param_var(self, param):
         """
@@ -114,15 +208,20 @@ class LlvmModule:
 
     def has_function(self, fun):
         """Check if module contains a function definition."""
-        pattern = re.compile(r"^define.*@{}\(".format(fun), flags=re.MULTILINE)
-        with open(self.llvm, "r") as llvm_file:
-            return pattern.search(llvm_file.read()) is not None
+        # If the module has been parsed, look the function up directly,
+        # otherwise avoid parsing the whole module and search the file.
+        if self.llvm_module is not None:
+            llvm_fun = self.llvm_module.get_function(fun)
+            return llvm_fun is not None and not llvm_fun.is_declaration()
+        self._load_symbol_defs()
+        return fun in self.function_defs
 
     def has_global(self, glob):
         """Check if module contains a global variable with the given name."""
-        pattern = re.compile(r"^@{}\s*=".format(glob), flags=re.MULTILINE)
-        with open(self.llvm, "r") as llvm_file:
-            return pattern.search(llvm_file.read()) is not None
+        if self.llvm_module is not None:
+            return self.llvm_module.has_global(glob)
+        self._load_symbol_defs()
+        return glob in self.global_defs
 
     def is_declaration(self, fun):
         """
@@ -144,7 +243,8 @@ class LlvmModule:
             self.llvm = self.unlinked_llvm
             self.unlinked_llvm = None
             self.linked_modules = set()
-            self.parse_module(True)
+            self.clean_module()
+            self._reset_file_info()
 
     def move_to_other_root_dir(self, old_root, new_root):
         """
@@ -158,15 +258,19 @@ class LlvmModule:
                                      os.path.relpath(self.llvm, old_root))
             # Copy the .ll file and replace all occurrences of the old root by
             # the new root. There are usually in debug info.
-            with open(self.llvm, "r") as llvm:
-                with open(dest_llvm, "w") as llvm_new:
-                    for line in llvm.readlines():
-                        if "constant" not in line:
-                            llvm_new.write(line.replace(old_root.strip("/"),
-                                                        new_root.strip("/")))
-                        else:
-                            llvm_new.write(line)
+            old_root_bytes = old_root.strip("/").encode("utf-8")
+            new_root_bytes = new_root.strip("/").encode("utf-8")
+            with open(self.llvm, "rb") as llvm:
+                text = llvm.read()
+            if old_root_bytes in text:
+                text = b"".join(
+                    line if b"constant" in line
+                    else line.replace(old_root_bytes, new_root_bytes)
+                    for line in text.splitlines(keepends=True))
+            with open(dest_llvm, "wb") as llvm_new:
+                llvm_new.write(text)
             self.llvm = dest_llvm
+            self._reset_file_info()
 
         if self.source and self.source.startswith(old_root):
             # Copy the C source file.
@@ -180,17 +284,18 @@ class LlvmModule:
         Get the list of source files that this module includes.
         Requires debugging information.
         """
-        # Search for all .h files mentioned in the debug info.
-        pattern = re.compile(r"filename:\s*\"([^\"]*)\", "
-                             r"directory:\s*\"([^\"]*)\"")
+        if self.included_sources is not None:
+            return set(self.included_sources)
+        # Search for all .h and .c files mentioned in the debug info.
+        with open(self.llvm, "rb") as llvm:
+            text = llvm.read()
         result = set()
-        with open(self.llvm, "r") as llvm:
-            for line in llvm.readlines():
-                s = pattern.search(line)
-                if (s and (s.group(1).endswith(".h") or
-                           s.group(1).endswith(".c"))):
-                    result.add(os.path.join(s.group(2), s.group(1)))
-        return result
+        for filename, directory in SOURCE_FILE_REGEX.findall(text):
+            if filename.endswith((b".h", b".c")):
+                result.add(os.path.join(directory.decode("utf-8"),
+                                        filename.decode("utf-8")))
+        self.included_sources = result
+        return set(result)
 
     def get_functions_using_param(self, param):
         """
@@ -205,8 +310,16 @@ class LlvmModule:
         Find names of all functions (recursively) called by one of functions
         in the given set.
         """
+        if fun_name in self.called_functions:
+            called = self.called_functions[fun_name]
+            return set(called) if called is not None else None
+
         self.parse_module()
         llvm_fun = self.llvm_module.get_function(fun_name)
+        called = None
         if llvm_fun:
-            return {f.get_name() for f in llvm_fun.get_called_functions()
-                    if f.get_name() not in supported_names.union({fun_name})}
+            called = {f.get_name() for f in llvm_fun.get_called_functions()}
+            called -= supported_names
+            called.discard(fun_name)
+        self.called_functions[fun_name] = called
+        return set(called) if called is not None else None
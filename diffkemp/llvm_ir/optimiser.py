@@ -4,17 +4,10 @@ from subprocess import check_call, CalledProcessError
 import os
 
 
-class BuildException(Exception):
-    pass
-
-
-def opt_llvm(llvm_file):
-    """
-    Optimize LLVM IR using 'opt' tool.
-    Run basic simplification passes and -constmerge to remove
-    duplicate constants that might have come from linked files.
-    """
-    passes = [("lowerswitch", "function"),
+# Simplification passes run on each module built from the sources. The last
+# pass runs -constmerge to remove duplicate constants that might have come
+# from linked files.
+OPT_PASSES = [("lowerswitch", "function"),
               ("mem2reg", "function"),
               ("loop-simplify", "function"),
               ("simplifycfg", "function"),
@@ -23,9 +16,27 @@ def opt_llvm(llvm_file):
               ("constmerge", "module"),
               ("mergereturn", "function"),
               ("simplifycfg", "function")]
-    opt_command = get_opt_command(passes, llvm_file)
+
+
+class BuildException(Exception):
+    pass
+
+
+def opt_llvm(llvm_file, stdin=None):
+    """
+    Optimize LLVM IR using 'opt' tool.
+    Run basic simplification passes (see OPT_PASSES).
+    :param llvm_file: LLVM IR file to optimize.
+    :param stdin: If given, the input IR is read from this file object (e.g.
+                  a pipe from clang) and the result is stored into llvm_file.
+    """
+    if stdin is None:
+        opt_command = get_opt_command(OPT_PASSES, llvm_file)
+    else:
+        opt_command = get_opt_command(OPT_PASSES, "-", overwrite=False)
+        opt_command.extend(["-S", "-o", llvm_file])
     try:
         with open(os.devnull, "w") as devnull:
-            check_call(opt_command, stderr=devnull)
+            check_call(opt_command, stdin=stdin, stderr=devnull)
     except CalledProcessError:
         raise BuildException("Running opt failed")
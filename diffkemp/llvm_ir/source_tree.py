@@ -4,6 +4,7 @@ Contains functions for getting LLVM modules from the project.
 """
 from diffkemp.llvm_ir.llvm_module import LlvmModule
 from diffkemp.llvm_ir.llvm_source_finder import SourceNotFoundException
+from concurrent.futures import ThreadPoolExecutor
 import os
 import shutil
 
@@ -106,24 +107,41 @@ class SourceTree:
                                    created corresponding to the sources
                                    structure).
         """
-        for mod in modules:
-            module_dir = os.path.dirname(
-                os.path.relpath(mod.llvm, self.source_dir))
-            target_module_dir = os.path.join(target_source_tree.source_dir,
-                                             module_dir)
-            os.makedirs(target_module_dir, exist_ok=True)
-
-            # Copy linked sources and headers.
-            for src_sourcefile in mod.get_included_sources():
-                if not src_sourcefile.startswith(self.source_dir):
-                    continue
-                dest_sourcefile = os.path.join(
-                    target_source_tree.source_dir,
-                    os.path.relpath(src_sourcefile, self.source_dir))
-                if not os.path.isfile(dest_sourcefile):
-                    os.makedirs(os.path.dirname(dest_sourcefile),
-                                exist_ok=True)
-                    shutil.copyfile(src_sourcefile, dest_sourcefile)
+        # Sources already processed for one of the modules. Modules usually
+        # share many headers, this avoids checking them again.
+        copied_sources = set()
+        source_prefix = os.path.join(self.source_dir, "")
+        target_prefix = os.path.join(target_source_tree.source_dir, "")
+        # The files are independent of each other, so they can be copied in
+        # parallel. Directories are created beforehand in this thread.
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            copies = []
+            for mod in modules:
+                module_dir = os.path.dirname(
+                    os.path.relpath(mod.llvm, self.source_dir))
+                target_module_dir = os.path.join(
+                    target_source_tree.source_dir, module_dir)
+                os.makedirs(target_module_dir, exist_ok=True)
+
+                # Copy linked sources and headers.
+                for src_sourcefile in mod.get_included_sources():
+                    if (src_sourcefile in copied_sources or
+                            not src_sourcefile.startswith(source_prefix)):
+                        continue
+                    copied_sources.add(src_sourcefile)
+                    dest_sourcefile = (target_prefix +
+                                       src_sourcefile[len(source_prefix):])
+                    if not os.path.isfile(dest_sourcefile):
+                        os.makedirs(os.path.dirname(dest_sourcefile),
+                                    exist_ok=True)
+                        copies.append(pool.submit(shutil.copyfile,
+                                                  src_sourcefile,
+                                                  dest_sourcefile))
+            # Wait for all copies (and propagate their errors) before moving
+            # the modules since moving writes to some of the same files.
+            for copy in copies:
+                copy.result()
 
+        for mod in modules:
             mod.move_to_other_root_dir(self.source_dir,
                                        target_source_tree.source_dir)
@@ -34,6 +34,15 @@ class SimpLLModule:
         self.pointer = lib.loadModule(ffi.new("char []", path.encode("ascii")))
         if self.pointer == ffi.NULL:
             raise ValueError("Cannot import module " + path)
+        # Cache of already looked-up functions (name -> function pointer).
+        # Only raw pointers are stored, SimpLLFunction objects reference the
+        # module and caching them would create a reference cycle that keeps
+        # the LLVM module alive until the garbage collector runs.
+        self.functions = dict()
+        # Cache of already found parameter variables (param -> var name).
+        # Names are stored as Python strings copied out of the module so that
+        # the cache neither refers back to the module nor to its memory.
+        self.param_vars = dict()
 
     def __eq__(self, other):
         return self.pointer == other.pointer
@@ -45,20 +54,30 @@ class SimpLLModule:
         lib.freeModule(self.pointer)
 
     def get_function(self, fun_name):
-        pointer = lib.getFunction(self.pointer,
-                                  ffi.new("char []", fun_name.encode("ascii")))
-        if pointer != ffi.NULL:
-            return SimpLLFunction(self, pointer)
+        if fun_name in self.functions:
+            pointer = self.functions[fun_name]
         else:
-            return None
+            pointer = lib.getFunction(
+                self.pointer, ffi.new("char []", fun_name.encode("ascii")))
+            self.functions[fun_name] = pointer
+        return (SimpLLFunction(self, pointer)
+                if pointer != ffi.NULL else None)
+
+    def has_global(self, glob_name):
+        return bool(lib.hasGlobal(self.pointer,
+                                  ffi.new("char []",
+                                          glob_name.encode("ascii"))))
 
     def find_param_var(self, param):
+        if param in self.param_vars:
+            return self.param_vars[param]
+
         result = lib.findParamVarC(ffi.new("char []", param.encode("ascii")),
                                    self.pointer)
-        if result != ffi.NULL:
-            return ffi.string(result).decode("ascii")
-        else:
-            return None
+        var = ffi.string(result).decode("ascii") if result != ffi.NULL \
+            else None
+        self.param_vars[param] = var
+        return var
 
     def get_functions_using_param(self, param, indices):
         # Convert indices into a C array.
@@ -82,6 +101,9 @@ class SimpLLModule:
 
     def preprocess(self, builtin_patterns):
         lib.preprocessModuleC(self.pointer, builtin_patterns)
+        # Preprocessing may remove functions and globals from the module
+        self.functions = dict()
+        self.param_vars = dict()
 
 
 class SimpLLFunction:
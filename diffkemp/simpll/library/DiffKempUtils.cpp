@@ -14,6 +14,7 @@
 //===----------------------------------------------------------------------===//
 
 #include "DiffKempUtils.h"
+#include <algorithm>
 #include <llvm/IR/GlobalVariable.h>
 #include <llvm/IR/Instructions.h>
 #include <llvm/IR/Operator.h>
@@ -23,32 +24,29 @@
 /// \param[in] ParamVar: LLVM expression containing the variable
 /// \return Name of the variable
 StringRef extractParamName(const Value *ParamVal) {
-    if (auto GVar = dyn_cast<GlobalVariable>(ParamVal)) {
-        StringRef ParamName = GVar->getName();
+    while (true) {
+        if (auto GVar = dyn_cast<GlobalVariable>(ParamVal)) {
+            StringRef ParamName = GVar->getName();
+
+            if (ParamName.find("__param_arr") == StringRef::npos
+                && ParamName.find("__param_string") == StringRef::npos)
+                return ParamName;
 
-        if (ParamName.find("__param_arr") != StringRef::npos
-            || ParamName.find("__param_string") != StringRef::npos) {
             // For array and string parameters, the actual variable is inside
             // another structure as its last element.
             auto Init = GVar->getInitializer();
             auto InitStr = dyn_cast<ConstantStruct>(Init);
             if (!InitStr)
                 return "";
-            auto VarExpr = InitStr->getOperand(InitStr->getNumOperands() - 1);
-
-            return extractParamName(VarExpr);
+            ParamVal = InitStr->getOperand(InitStr->getNumOperands() - 1);
+        } else if (auto CExpr = dyn_cast<ConstantExpr>(ParamVal)) {
+            // Variable can be inside bitcast or getelementptr, in both cases it
+            // is inside the first operand of the expression.
+            ParamVal = CExpr->getOperand(0);
         } else {
-            return ParamName;
+            return "";
         }
     }
-
-    if (auto CExpr = dyn_cast<ConstantExpr>(ParamVal)) {
-        // Variable can be inside bitcast or getelementptr, in both cases it is
-        // inside the first operand of the expression.
-        return extractParamName(CExpr->getOperand(0));
-    }
-
-    return "";
 }
 
 /// Checks whether the indices in the GEP correspond to the indices in
@@ -60,16 +58,14 @@ StringRef extractParamName(const Value *ParamVal) {
 /// GEP operator with.
 /// \return True or false based on whether the indices correspond.
 bool checkGEPIndicesCorrespond(const GEPOperator *GEP,
-                               std::vector<int> indices) {
-    for (unsigned i = 1; i < GEP->getNumOperands(); i++) {
-        if ((i - 1) >= indices.size()) {
-            auto Op = GEP->getOperand(i);
-            if (isa<ConstantInt>(Op)
-                && (dyn_cast<ConstantInt>(Op)->getZExtValue()
-                    != (unsigned)indices[i - 1])) {
-                return false;
-            }
-        }
+                               const std::vector<int> &indices) {
+    // Only the indices present both in the GEP and in the list are compared.
+    unsigned Count = std::min<size_t>(GEP->getNumOperands() - 1,
+                                      indices.size());
+    for (unsigned i = 0; i < Count; i++) {
+        auto Index = dyn_cast<ConstantInt>(GEP->getOperand(i + 1));
+        if (Index && Index->getZExtValue() != (unsigned)indices[i])
+            return false;
     }
 
     return true;
@@ -77,7 +73,7 @@ bool checkGEPIndicesCorrespond(const GEPOperator *GEP,
 
 /// Find names of all functions using the given parameter (global variable).
 std::set<StringRef> getFunctionsUsingParam(std::string Param,
-                                           std::vector<int> indices,
+                                           const std::vector<int> &indices,
                                            const Module *Mod) {
     auto Glob = Mod->getNamedGlobal(Param);
     if (!Glob)
@@ -32,5 +32,5 @@ StringRef findParamVar(std::string Param, const Module *Mod);
 
 /// Find names of all functions using the given parameter (global variable).
 std::set<StringRef> getFunctionsUsingParam(std::string Param,
-                                           std::vector<int> indices,
+                                           const std::vector<int> &indices,
                                            const Module *Mod);
@@ -121,6 +121,12 @@ int isDeclaration(void *FunRaw) {
     return Fun->isDeclaration();
 }
 
+int hasGlobal(void *ModRaw, const char *Name) {
+    Module *Mod = (Module *)ModRaw;
+    GlobalValue *Global = Mod->getNamedValue(std::string(Name));
+    return Global && !isa<Function>(Global);
+}
+
 /// Get all functions recursively called by FunRaw.
 /// Note: this is a C interface wrapper for CalledFunctionsAnalysis.
 struct ptr_array getCalledFunctions(void *FunRaw) {
@@ -75,6 +75,10 @@ const char *getFunctionName(void *FunRaw);
 
 int isDeclaration(void *FunRaw);
 
+/// Check whether the module contains a global value other than a function
+/// (global variable, alias, or ifunc) of the given name.
+int hasGlobal(void *ModRaw, const char *Name);
+
 /// Get all functions recursively called by FunRaw.
 /// Note: this is a C interface wrapper for CalledFunctionsAnalysis.
 struct ptr_array getCalledFunctions(void *FunRaw);
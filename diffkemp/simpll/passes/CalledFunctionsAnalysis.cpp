@@ -30,48 +30,61 @@ CalledFunctionsAnalysis::Result CalledFunctionsAnalysis::run(
     return result;
 }
 
-/// Recursively collect all functions potentially called by Fun and add them to
-/// the Called set. All functions called by 'call' instructions and used as
-/// operands to some instructions in Fun are collected.
+/// Collect all functions potentially called by Fun and add them to the Called
+/// set. All functions called by 'call' instructions and used as operands to
+/// some instructions in Fun are collected.
+/// Functions are processed using an explicit worklist instead of recursion
+/// since call chains in large modules may be very deep.
 void CalledFunctionsAnalysis::collectCalled(const Function *Fun,
                                             Result &Called) {
-    if (!Called.insert(Fun).second)
-        return;
+    std::vector<const Function *> Worklist{Fun};
+    while (!Worklist.empty()) {
+        const Function *Current = Worklist.back();
+        Worklist.pop_back();
+        if (!Called.insert(Current).second)
+            continue;
 
-    for (auto &BB : *Fun) {
-        for (auto &Inst : BB) {
-            if (auto Call = dyn_cast<CallInst>(&Inst)) {
-                if (auto *CalledFun = getCalledFunction(Call)) {
-                    collectCalled(CalledFun, Called);
+        for (auto &BB : *Current) {
+            for (auto &Inst : BB) {
+                if (auto Call = dyn_cast<CallInst>(&Inst)) {
+                    if (auto *CalledFun = getCalledFunction(Call)) {
+                        Worklist.push_back(CalledFun);
+                    }
+                }
+                for (auto &Op : Inst.operands()) {
+                    processValue(Op, Worklist);
                 }
-            }
-            for (auto &Op : Inst.operands()) {
-                processValue(Op, Called);
             }
         }
     }
 }
 
 /// Looks for functions in a value (either a function itself, or a composite
-/// type constant).
-void CalledFunctionsAnalysis::processValue(const Value *Val, Result &Called) {
-    if (!ProcessedValues.insert(Val).second)
-        return;
+/// type constant) and adds them to the worklist of functions to process.
+void CalledFunctionsAnalysis::processValue(
+        const Value *Val, std::vector<const Function *> &Worklist) {
+    std::vector<const Value *> Values{Val};
+    while (!Values.empty()) {
+        const Value *Current = Values.back();
+        Values.pop_back();
+        if (!ProcessedValues.insert(Current).second)
+            continue;
 
-    if (auto Fun = valueToFunction(Val))
-        collectCalled(Fun, Called);
-    else if (auto GV = dyn_cast<GlobalVariable>(Val)) {
-        if (GV->hasInitializer() && GV->isConstant())
-            // The initializer is constant - see whether it contains
-            // a function (or a user type constant that contains
-            // a function).
-            processValue(GV->getInitializer(), Called);
-    } else if (auto BitCast = dyn_cast<BitCastOperator>(Val)) {
-        processValue(BitCast->getOperand(0), Called);
-    } else if (isa<Constant>(Val)) {
-        if (auto U = dyn_cast<User>(Val)) {
-            for (auto &UserOp : U->operands()) {
-                processValue(UserOp.get(), Called);
+        if (auto Fun = valueToFunction(Current))
+            Worklist.push_back(Fun);
+        else if (auto GV = dyn_cast<GlobalVariable>(Current)) {
+            if (GV->hasInitializer() && GV->isConstant())
+                // The initializer is constant - see whether it contains
+                // a function (or a user type constant that contains
+                // a function).
+                Values.push_back(GV->getInitializer());
+        } else if (auto BitCast = dyn_cast<BitCastOperator>(Current)) {
+            Values.push_back(BitCast->getOperand(0));
+        } else if (isa<Constant>(Current)) {
+            if (auto U = dyn_cast<User>(Current)) {
+                for (auto &UserOp : U->operands()) {
+                    Values.push_back(UserOp.get());
+                }
             }
         }
     }
@@ -20,6 +20,7 @@
 #include <llvm/IR/PassManagerImpl.h>
 #endif
 #include <set>
+#include <vector>
 
 using namespace llvm;
 
@@ -38,13 +39,16 @@ class CalledFunctionsAnalysis
     void collectCalled(const Function *Fun, Result &Called);
     /// Looks for functions in a value (either a function itself, or a composite
     /// type constant).
-    void processValue(const Value *Val, Result &Called);
+    /// \param Val
+    /// \param Worklist Functions found in the value are added here.
+    void processValue(const Value *Val,
+                      std::vector<const Function *> &Worklist);
 
   private:
     friend AnalysisInfoMixin<CalledFunctionsAnalysis>;
     static AnalysisKey Key;
     /// The set of values that were already processed in the current run.
-    /// Prevents infinite recursion when processing instruction operands.
+    /// Prevents infinite looping when processing instruction operands.
     std::set<const Value *> ProcessedValues;
 };
 
@@ -1,3 +1,5 @@
+from functools import lru_cache
+from itertools import groupby
 import os
 import subprocess
 import re
@@ -17,9 +19,11 @@ def get_simpll_build_dir():
     return "build"
 
 
+@lru_cache(maxsize=None)
 def get_llvm_version():
     """
     Return the current LLVM major version number.
+    The version is determined only once since it cannot change during a run.
     """
     return int(subprocess.check_output(
         ["llvm-config", "--version"]).decode().rstrip().split(".")[0])
@@ -31,9 +35,15 @@ def get_opt_command(passes, llvm_file, overwrite=True):
     The `passes` argument is a list of tuples `(pass_name, IR_unit)`.
     """
     opt_command = ["opt", llvm_file]
-    if get_llvm_version() >= 16:
-        # The new PM expects passes as "-passes=function(pass1),module(pass2)"
-        passes_formatted = map(lambda p: f"{p[1]}({p[0]})", passes)
+    if get_llvm_version() >= 13:
+        # The new PM (default since LLVM 13) expects passes as
+        # "-passes=function(pass1,pass2),module(pass3)". Consecutive passes
+        # over the same IR unit are grouped so that they run in a single
+        # pass manager (e.g. all function passes run on one function before
+        # moving to the next one).
+        passes_formatted = [
+            "{}({})".format(unit, ",".join(p[0] for p in unit_passes))
+            for unit, unit_passes in groupby(passes, key=lambda p: p[1])]
         opt_command.append("-passes=" + ",".join(passes_formatted))
     else:
         # The legacy PM expects passes as "-pass1 -pass2"
@@ -6,8 +6,13 @@ Mostly tests for the KernelLlvmSourceBuilder class.
 from diffkemp.llvm_ir.kernel_llvm_source_builder import \
     KernelLlvmSourceBuilder, BuildException
 from diffkemp.llvm_ir.source_tree import SourceNotFoundException
+import diffkemp.llvm_ir.kernel_llvm_source_builder as source_builder
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE
 import pytest
 import os
+import shutil
+import sys
 
 
 versions = ("kernel/linux-3.10", "kernel/linux-3.10.0-957.el7")
@@ -146,3 +151,257 @@ def test_finalize():
     # Check that "asm goto" has been re-enabled.
     with open(gcc_header_path, "r") as gcc_header:
         assert "asm goto(x)" in gcc_header.read()
+
+
+def test_finalize_restores_compiler_headers(tmp_path):
+    """
+    Compiler headers rewritten when creating the builder are restored to
+    their original contents (and permissions) by finalize.
+    """
+    include_dir = tmp_path / "include" / "linux"
+    include_dir.mkdir(parents=True)
+    headers = {
+        include_dir / "compiler-gcc.h":
+            b"#define asm_volatile_goto(x...) "
+            b"do { asm goto(x); asm (\"\"); } while (0)\n",
+        include_dir / "compiler_types.h":
+            b"#ifdef CONFIG_CC_HAS_ASM_INLINE\n"
+            b"#define asm_inline asm __inline\n"
+            b"#endif\n"
+    }
+    for header, content in headers.items():
+        header.write_bytes(content)
+        header.chmod(0o640)
+
+    builder = KernelLlvmSourceBuilder(str(tmp_path))
+    for header, content in headers.items():
+        assert header.read_bytes() != content
+    builder.finalize()
+    for header, content in headers.items():
+        assert header.read_bytes() == content
+        assert header.stat().st_mode & 0o777 == 0o640
+    assert sorted(os.listdir(str(include_dir))) == \
+        ["compiler-gcc.h", "compiler_types.h"]
+
+
+FAKE_CSCOPE = """
+import sys
+results = {
+    "1foo": ["kernel/foo.c foo 10 int foo(void)",
+             "include/foo.h foo 3 int foo(void);"],
+    "1none": [],
+}
+sys.stdout.write(">> ")
+sys.stdout.flush()
+for line in sys.stdin:
+    query = line.rstrip("\\n")
+    if query == "1noheader":
+        # Only the prompt is printed
+        sys.stdout.write(">> ")
+        sys.stdout.flush()
+        continue
+    if query == "1cut":
+        # Terminate in the middle of the results
+        sys.stdout.write("cscope: 3 lines\\nkernel/cut.c cut 1 int cut;\\n")
+        break
+    if query not in results:
+        break
+    sys.stdout.write("cscope: {} lines\\n".format(len(results[query])))
+    for result in results[query]:
+        sys.stdout.write(result + "\\n")
+    sys.stdout.write(">> ")
+    sys.stdout.flush()
+"""
+
+
+def start_fake_cscope(builder, tmp_path):
+    """Replace the cscope process of the builder by a fake one."""
+    script = tmp_path / "cscope.py"
+    script.write_text(FAKE_CSCOPE)
+    builder.cscope_process = Popen([sys.executable, str(script)],
+                                   stdin=PIPE, stdout=PIPE, encoding="utf-8")
+    builder.cscope_process.stdout.read(len(source_builder.CSCOPE_PROMPT))
+
+
+def test_cscope_query(tmp_path):
+    """
+    Test searching in a running cscope process (replaced by a fake process
+    using the same line-oriented protocol).
+    """
+    builder = KernelLlvmSourceBuilder(str(tmp_path))
+    start_fake_cscope(builder, tmp_path)
+
+    # Multiple results, only C sources are kept by _cscope_run.
+    assert builder._cscope_query("foo", True) == [
+        "kernel/foo.c foo 10 int foo(void)",
+        "include/foo.h foo 3 int foo(void);"]
+    assert builder._cscope_run("foo", True) == [
+        "kernel/foo.c foo 10 int foo(void)"]
+    # No results.
+    assert builder._cscope_query("none", True) == []
+    # The process terminates (the fake exits on an unknown query).
+    assert builder._cscope_query("die", True) is None
+    assert builder.cscope_process is None
+    builder.finalize()
+
+
+def test_cscope_query_malformed_output(tmp_path):
+    """
+    Test that a search printing no header does not block and that a process
+    terminating in the middle of the results is handled.
+    """
+    builder = KernelLlvmSourceBuilder(str(tmp_path))
+    start_fake_cscope(builder, tmp_path)
+
+    # No header, the process keeps running and answers further searches.
+    assert builder._cscope_query("noheader", True) is None
+    assert builder._cscope_query("none", True) == []
+    # Fewer result lines than announced by the header.
+    assert builder._cscope_query("cut", True) is None
+    assert builder.cscope_process is None
+    builder.finalize()
+
+
+def test_cscope_database_built_lazily(tmp_path):
+    """
+    Creating and finalizing a builder that is never queried must not build
+    the cscope database (e.g. for snapshot directories).
+    """
+    builder = KernelLlvmSourceBuilder(str(tmp_path))
+    builder.finalize()
+    assert not os.path.exists(os.path.join(str(tmp_path), "cscope.files"))
+
+
+def fake_tool(monkeypatch, tmp_path, name, script):
+    """
+    Create a fake executable with the given name running a shell script and
+    put it in front of PATH.
+    """
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir(exist_ok=True)
+    tool = bin_dir / name
+    tool.write_text("#!/bin/sh\n" + script)
+    tool.chmod(0o755)
+    monkeypatch.setenv("PATH", "{}{}{}".format(bin_dir, os.pathsep,
+                                               os.environ["PATH"]))
+
+
+@pytest.mark.skipif(shutil.which("opt") is None, reason="opt not installed")
+def test_build_src_to_llvm_clang_fail(tmp_path, monkeypatch):
+    """
+    A source that Clang fails to compile must not leave an (empty) LLVM IR
+    file behind that would be considered up-to-date by later builds. Clang is
+    replaced by a failing command producing no output, on which opt succeeds.
+    """
+    fake_tool(monkeypatch, tmp_path, "clang", "exit 1\n")
+    with open(os.path.join(str(tmp_path), "broken.c"), "w") as source:
+        source.write("this is not C\n")
+    builder = KernelLlvmSourceBuilder(str(tmp_path))
+    builder.kbuild_object_commands["broken.o"] = \
+        "gcc -c -o broken.o broken.c"
+    for _ in range(2):
+        with pytest.raises(BuildException):
+            builder._build_source_to_llvm("broken.c")
+        assert not os.path.exists(os.path.join(str(tmp_path), "broken.ll"))
+    builder.finalize()
+
+
+def test_kbuild_object_command_parallel(tmp_path, monkeypatch):
+    """
+    When multiple threads miss the command of the same object at once, make
+    is run only once for it.
+    """
+    make_log = tmp_path / "make.log"
+    fake_tool(monkeypatch, tmp_path, "make",
+              'echo "$@" >> {}\n'
+              "sleep 0.2\n"
+              'echo "gcc -c -o a.o a.c"\n'.format(make_log))
+    builder = KernelLlvmSourceBuilder(str(tmp_path))
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        commands = list(pool.map(builder._kbuild_object_command,
+                                 ["a.o"] * 4))
+    assert commands == ["gcc -c -o a.o a.c"] * 4
+    assert len(make_log.read_text().splitlines()) == 1
+    builder.finalize()
+
+
+def test_llvm_cache_disabled(tmp_path, monkeypatch):
+    """The LLVM IR cache is disabled unless its size is set."""
+    monkeypatch.delenv("DIFFKEMP_LLVM_CACHE_SIZE", raising=False)
+    builder = KernelLlvmSourceBuilder(str(tmp_path))
+    assert builder.llvm_cache_size == 0
+    assert builder._llvm_cache_file(["clang", "-o", "a.ll", "a.c"]) is None
+    builder.finalize()
+
+
+def test_llvm_cache_file(tmp_path, monkeypatch):
+    """
+    The LLVM IR cache entry is given by the contents of the files listed in
+    the dependency file of the build.
+    """
+    monkeypatch.setenv("DIFFKEMP_LLVM_CACHE_SIZE", "1")
+    monkeypatch.setattr(source_builder, "LLVM_CACHE_DIR",
+                        str(tmp_path / "cache"))
+    (tmp_path / "a.c").write_text('#include "a.h"\n')
+    (tmp_path / "a.h").write_text("int a;\n")
+    builder = KernelLlvmSourceBuilder(str(tmp_path))
+    builder.clang_version = b"clang"
+    builder.opt_version = b"opt"
+    command = ["clang", "-Wp,-MD,.a.o.d", "-c", "a.c", "-o", "a.ll"]
+
+    # No dependency file before the first build.
+    assert builder._llvm_cache_file(command) is None
+
+    (tmp_path / ".a.o.d").write_text("a.o: a.c \\\n  a.h\n")
+    cache_file = builder._llvm_cache_file(command)
+    assert cache_file is not None
+    assert builder._llvm_cache_file(command) == cache_file
+    # Changing an included header changes the cache entry.
+    (tmp_path / "a.h").write_text("int b;\n")
+    assert builder._llvm_cache_file(command) != cache_file
+    builder.finalize()
+
+
+def test_load_from_llvm_cache_missing(tmp_path):
+    """A cache entry removed concurrently makes the lookup fail cleanly."""
+    assert not KernelLlvmSourceBuilder._load_from_llvm_cache(
+        str(tmp_path / "missing.ll"), str(tmp_path / "a.ll"))
+    assert not os.path.exists(str(tmp_path / "a.ll"))
+
+
+def test_prune_llvm_cache(tmp_path, monkeypatch):
+    """Least recently used files are removed when the cache is too big."""
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    monkeypatch.setattr(source_builder, "LLVM_CACHE_DIR", str(cache_dir))
+    for i, name in enumerate(["old.ll", "mid.ll", "new.ll"]):
+        cache_file = cache_dir / name
+        cache_file.write_text("x" * 10)
+        os.utime(str(cache_file), (i, i))
+    builder = KernelLlvmSourceBuilder(str(tmp_path))
+    builder.llvm_cache_size = 20
+    builder.finalize()
+    assert sorted(os.listdir(str(cache_dir))) == ["mid.ll", "new.ll"]
+
+
+def test_cscope_cache_persisted(tmp_path):
+    """Results of cscope queries are reused by a builder for the same tree."""
+    (tmp_path / "cscope.out").write_text("")
+    builder = KernelLlvmSourceBuilder(str(tmp_path))
+    builder.cscope_cache[("foo", True)] = ["kernel/foo.c foo 1 int foo()"]
+    builder.cscope_cache[("foo", False)] = []
+    builder.finalize()
+
+    builder = KernelLlvmSourceBuilder(str(tmp_path))
+    assert builder.cscope_cache == {
+        ("foo", True): ["kernel/foo.c foo 1 int foo()"],
+        ("foo", False): []
+    }
+    builder.finalize()
+
+    # A corrupted cache file is ignored.
+    with open(builder.cscope_cache_file, "w") as cache_file:
+        cache_file.write("{")
+    builder = KernelLlvmSourceBuilder(str(tmp_path))
+    assert builder.cscope_cache == {}
+    builder.finalize()
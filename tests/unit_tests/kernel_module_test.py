@@ -39,6 +39,23 @@ def test_has_global(mod):
         assert mod.has_global(g)
 
 
+def test_has_global_parsed(tmp_path):
+    """
+    Test that looking up globals gives the same results whether the module
+    has been parsed or not.
+    """
+    llvm_file = tmp_path / "mod.ll"
+    llvm_file.write_text("@glob = global i32 0\n"
+                         "define void @fun() {\n  ret void\n}\n")
+    mod = LlvmModule(str(llvm_file))
+    for parse in [False, True]:
+        if parse:
+            mod.parse_module()
+        assert mod.has_global("glob")
+        assert not mod.has_global("missing")
+        assert not mod.has_global("fun")
+
+
 def test_is_declaration(mod):
     """Test checking if module has a function declaration."""
     for f in ["snd_card_locked", "mutex_lock"]:
@@ -63,6 +80,32 @@ def test_link_modules(source, mod):
     assert not mod.links_mod(init)
 
 
+def test_relink_modules_after_change(tmp_path):
+    """
+    Test that linking the same modules again after restoring the unlinked
+    module does not reuse the previously linked file if one of the linked
+    modules has changed in the meantime.
+    """
+    def write_llvm(path, functions):
+        path.write_text("".join(
+            "define void @{}() {{\n  ret void\n}}\n".format(f)
+            for f in functions))
+        return str(path)
+
+    mod = LlvmModule(write_llvm(tmp_path / "a.ll", ["a"]))
+    dep = LlvmModule(write_llvm(tmp_path / "b.ll", ["b"]))
+    assert mod.link_modules([dep])
+    assert mod.has_function("b")
+    mod.restore_unlinked_llvm()
+
+    # Rebuild the dependency with a different content.
+    write_llvm(tmp_path / "b.ll", ["b", "c"])
+    os.utime(dep.llvm, ns=(0, 0))
+    assert mod.link_modules([dep])
+    assert mod.has_function("b")
+    assert mod.has_function("c")
+
+
 def test_find_param_var():
     """
     Test finding the name of a variable corresponding to a module parameter.
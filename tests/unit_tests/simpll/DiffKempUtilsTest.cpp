@@ -0,0 +1,81 @@
+//===----------------- DiffKempUtilsTest.cpp - Unit tests -----------------===//
+//
+//       SimpLL - Program simplifier for analysis of semantic difference      //
+//
+// This file is published under Apache 2.0 license. See LICENSE for details.
+//===----------------------------------------------------------------------===//
+///
+/// \file
+/// This file contains unit tests for utility functions used in the generate
+/// phase of DiffKemp.
+///
+//===----------------------------------------------------------------------===//
+
+#include <gtest/gtest.h>
+#include <library/DiffKempUtils.h>
+#include <llvm/IRReader/IRReader.h>
+#include <llvm/Support/SourceMgr.h>
+
+/// Module with functions accessing different fields of a global variable
+/// through GEPs with different numbers of indices.
+static const char *TestModule = R"(
+    %struct.S = type { i32, [4 x i32] }
+    @param = global %struct.S zeroinitializer
+
+    define void @use_short() {
+      %1 = getelementptr %struct.S, %struct.S* @param, i64 0
+      ret void
+    }
+
+    define void @use_long() {
+      %1 = getelementptr %struct.S, %struct.S* @param, i64 0, i32 1, i64 2
+      ret void
+    }
+
+    define void @use_other() {
+      %1 = getelementptr %struct.S, %struct.S* @param, i64 0, i32 0
+      ret void
+    }
+)";
+
+/// Test fixture providing the parsed test module.
+class DiffKempUtilsTest : public ::testing::Test {
+  public:
+    LLVMContext Ctx;
+    std::unique_ptr<Module> Mod;
+
+    DiffKempUtilsTest() : ::testing::Test() {
+        SMDiagnostic Err;
+        Mod = parseIR(MemoryBufferRef(TestModule, "testmod"), Err, Ctx);
+    }
+};
+
+/// Indices searched for are longer than the GEP indices in @use_short and
+/// shorter than the GEP indices in @use_long. Only the common indices are
+/// compared.
+TEST_F(DiffKempUtilsTest, GetFunctionsUsingParamIndicesLength) {
+    ASSERT_TRUE(Mod);
+    auto Funs = getFunctionsUsingParam("param", {0, 1}, Mod.get());
+    ASSERT_EQ(Funs, std::set<StringRef>({"use_short", "use_long"}));
+
+    Funs = getFunctionsUsingParam("param", {0, 1, 2, 3}, Mod.get());
+    ASSERT_EQ(Funs, std::set<StringRef>({"use_short", "use_long"}));
+}
+
+/// A mismatch in any of the common indices excludes the function.
+TEST_F(DiffKempUtilsTest, GetFunctionsUsingParamIndicesMismatch) {
+    ASSERT_TRUE(Mod);
+    auto Funs = getFunctionsUsingParam("param", {0, 1, 3}, Mod.get());
+    ASSERT_EQ(Funs, std::set<StringRef>({"use_short"}));
+
+    Funs = getFunctionsUsingParam("param", {0, 0}, Mod.get());
+    ASSERT_EQ(Funs, std::set<StringRef>({"use_short", "use_other"}));
+}
+
+/// Without indices, all functions using the global variable are found.
+TEST_F(DiffKempUtilsTest, GetFunctionsUsingParamNoIndices) {
+    ASSERT_TRUE(Mod);
+    auto Funs = getFunctionsUsingParam("param", {}, Mod.get());
+    ASSERT_EQ(Funs,
+              std::set<StringRef>({"use_short", "use_long", "use_other"}));
+}
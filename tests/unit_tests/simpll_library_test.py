@@ -0,0 +1,92 @@
+"""
+Unit tests for the Python interface of the SimpLL library.
+Testing classes located in simpll/library.py.
+"""
+
+from diffkemp.simpll.library import SimpLLModule
+import gc
+import pytest
+import weakref
+
+LLVM_MODULE = """
+@glob = global i32 0
+@__param_par = internal constant { i8*, { i8* } }
+  { i8* null, { i8* } { i8* bitcast (i32* @glob to i8*) } }
+
+define i32 @fun() {
+  %1 = load i32, i32* @glob
+  ret i32 %1
+}
+
+declare void @decl()
+"""
+
+
+@pytest.fixture
+def llvm_file(tmp_path):
+    """Create a small LLVM IR file."""
+    path = tmp_path / "mod.ll"
+    path.write_text(LLVM_MODULE)
+    return str(path)
+
+
+def test_get_function(llvm_file):
+    """Test looking up functions, including repeated (cached) lookups."""
+    module = SimpLLModule(llvm_file)
+    for _ in range(2):
+        fun = module.get_function("fun")
+        assert fun.get_name() == "fun"
+        assert not fun.is_declaration()
+        assert module.get_function("decl").is_declaration()
+        assert module.get_function("missing") is None
+
+
+def test_has_global(llvm_file):
+    """Test checking if the module contains a global variable."""
+    module = SimpLLModule(llvm_file)
+    assert module.has_global("glob")
+
+
+def test_has_global_missing(llvm_file):
+    """Test that functions and unknown names are not reported as globals."""
+    module = SimpLLModule(llvm_file)
+    assert not module.has_global("missing")
+    assert not module.has_global("fun")
+
+
+def test_get_function_no_cycle(llvm_file):
+    """Test that cached function lookups do not keep the module alive."""
+    module = SimpLLModule(llvm_file)
+    module.get_function("fun")
+    module.get_function("missing")
+    # Without a reference cycle, the module is freed immediately.
+    module_ref = weakref.ref(module)
+    gc.disable()
+    try:
+        del module
+        assert module_ref() is None
+    finally:
+        gc.enable()
+
+
+def test_find_param_var(llvm_file):
+    """Test finding the variable of a parameter, including cached lookups."""
+    module = SimpLLModule(llvm_file)
+    for _ in range(2):
+        assert module.find_param_var("par") == "glob"
+        assert module.find_param_var("missing") is None
+
+
+def test_find_param_var_no_cycle(llvm_file):
+    """Test that cached parameter lookups do not keep the module alive."""
+    module = SimpLLModule(llvm_file)
+    var = module.find_param_var("par")
+    module_ref = weakref.ref(module)
+    gc.disable()
+    try:
+        del module
+        assert module_ref() is None
+    finally:
+        gc.enable()
+    # The returned name stays valid after the module is freed.
+    assert var == "glob"